@@ -1,60 +1,146 @@
 # app.py
 import streamlit as st
 import pandas as pd
-import importlib.util
-import tempfile
-import os
+import numpy as np
+import hashlib
+import inspect
+import linecache
+import types
+import weakref
 import io
 import traceback
+import pickle
+
+# python-calamine (Rust) parses .xlsx several times faster than openpyxl; use it when installed
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
 
 st.set_page_config(page_title="Dynamic Rule-Based Data Verification", layout="wide")
 st.title("📊 Dynamic Rule-Based Data Verification (Step 1)")
 
 st.markdown(
     """
-This app loads a **rules .py** file (must provide `check_rules(excel_file)`), and an **Excel/CSV** file to validate.
+This app loads a **rules .py** file (must provide `check_rules(excel_file)`; rules that also accept `prefetched=` receive the already parsed sheets), and an **Excel/CSV** file to validate.
 Step 1: load rules, preview data, run validation, show a compact summary of findings.
-After you confirm this works we will add tabs, row highlighting, charts and downloads.
+Each sheet gets its own tab. After you confirm this works we will add row highlighting, charts and downloads.
 """
 )
 
 # --------------------- Helpers ---------------------
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_rules_module(py_bytes: bytes, filename: str) -> types.ModuleType:
+    """
+    Compile the rules source in memory and execute it as a fresh module (no temp file).
+    Cached per content, so reruns with the same upload reuse the already executed module.
+    """
+    # the content digest keeps two uploads with the same file name apart in tracebacks
+    origin = f"<rules:{filename}:{hashlib.sha256(py_bytes).hexdigest()[:12]}>"
+    code = compile(py_bytes, origin, "exec")
+    # register the source so tracebacks from the rules file still show its lines
+    source = py_bytes.decode("utf-8", errors="replace")
+    linecache.cache[origin] = (len(source), None, source.splitlines(True), origin)
+    module = types.ModuleType("rules_module")
+    module.__file__ = origin
+    # drop the source again once the module is gone (evicted from the cache, or failed to import)
+    weakref.finalize(module, linecache.cache.pop, origin, None)
+    exec(code, module.__dict__)
+    return module
+
 def safe_import_pyfile(uploaded_file) -> tuple:
     """
-    Save uploaded .py to a temp file and import it as a module.
-    Returns (module, temp_path) or (None, None) on failure.
+    Import an uploaded .py file as a module (see load_rules_module).
+    Returns (module, module_origin); raises if the file fails to import.
     """
-    try:
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".py")
-        tmp.write(uploaded_file.getbuffer())
-        tmp.flush()
-        tmp.close()
-        spec = importlib.util.spec_from_file_location("rules_module", tmp.name)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        return module, tmp.name
-    except Exception as e:
-        # cleanup
-        try:
-            tmp_name = tmp.name
-            if os.path.exists(tmp_name):
-                os.unlink(tmp_name)
-        except Exception:
-            pass
-        raise
+    module = load_rules_module(uploaded_file.getvalue(), uploaded_file.name)
+    return module, module.__file__
+
+def nonempty_cells(col: pd.Series) -> np.ndarray:
+    """Mask of cells in `col` that hold a value; text only counts when it is not blank."""
+    if pd.api.types.is_object_dtype(col) or pd.api.types.is_string_dtype(col):
+        # nullable "string" dtype: reuses the str objects, NaN stays <NA> instead of becoming "nan"
+        lengths = col.astype("string").str.strip().str.len()
+        return lengths.gt(0).fillna(False).to_numpy(dtype=bool)
+    # numbers, booleans, dates: any present value counts, no text conversion needed
+    return col.notna().to_numpy()
 
 def count_findings_in_df(df: pd.DataFrame) -> int:
     """Count rows that contain any non-empty 'Comment' (preferred) or any Error/Check columns."""
     if df is None or not isinstance(df, pd.DataFrame) or df.empty:
         return 0
     if "Comment" in df.columns:
-        return df["Comment"].astype(str).str.strip().ne("").sum()
-    # fallback to _Error / Duplicate / _check
-    cand = [c for c in df.columns if ("Error" in c or "Duplicate" in c or c.lower().endswith("_check"))]
-    if not cand:
+        labels = ["Comment"]
+    else:
+        # fallback to _Error / Duplicate / _check
+        # (each label once: duplicated labels are all reached through get_indexer_for below;
+        # labels are not always strings, e.g. integer headers)
+        labels = [c for c in dict.fromkeys(df.columns) if ("Error" in str(c) or "Duplicate" in str(c) or str(c).lower().endswith("_check"))]
+        if not labels:
+            return 0
+    # columns are taken by position: a duplicated label would make df[label] a DataFrame
+    positions = df.columns.get_indexer_for(labels)
+    if df.iloc[:, positions].isna().to_numpy().all():
+        # clean sheet: nothing to strip or measure
         return 0
-    mask = df[cand].astype(str).apply(lambda col: col.str.strip() != "")
-    return mask.any(axis=1).sum()
+    mask = np.zeros(len(df), dtype=bool)
+    for i in positions:
+        mask |= nonempty_cells(df.iloc[:, i])
+        if mask.all():
+            # every row already has a finding; the remaining columns cannot change the count
+            break
+    return int(mask.sum())
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def read_excel_preview(file_bytes: bytes, name: str, nrows: int = 10) -> tuple:
+    """Return (first sheet name, first `nrows` rows) of an uploaded Excel file, cached on its contents."""
+    xls = pd.ExcelFile(io.BytesIO(file_bytes), engine=EXCEL_ENGINE)
+    first_sheet = xls.sheet_names[0]
+    # only the rows we display are parsed, not the whole sheet
+    return first_sheet, xls.parse(first_sheet, nrows=nrows)
+
+def parse_all_sheets(file_bytes: bytes) -> dict:
+    """Parse every sheet of an Excel file in one go; returns {sheet name: DataFrame}."""
+    return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, engine=EXCEL_ENGINE)
+
+def accepts_prefetched(func) -> bool:
+    """True if `func` declares a `prefetched` parameter for already parsed sheets."""
+    try:
+        return "prefetched" in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+class UncacheableResult(Exception):
+    """Raised by run_rules to hand back a check_rules result that st.cache_data cannot pickle."""
+    def __init__(self, result):
+        super().__init__("check_rules returned a result that cannot be cached")
+        self.result = result
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def run_rules(file_bytes: bytes, name: str, rules_digest: str, _rules_module):
+    """
+    Run `check_rules` on the uploaded data file.
+    Excel uploads are parsed here once and passed as `prefetched` to rules that accept it.
+    Cached on the data bytes and the rules file digest, so reruns with the same inputs skip the work.
+    Results that cannot be pickled (a Styler, a lambda, a class from the rules file) are raised
+    back in UncacheableResult, which st.cache_data does not store.
+    """
+    data = io.BytesIO(file_bytes)
+    data.name = name
+    check_rules = _rules_module.check_rules
+    if name.lower().endswith(".xlsx") and accepts_prefetched(check_rules):
+        results = check_rules(data, prefetched=parse_all_sheets(file_bytes))
+    else:
+        results = check_rules(data)
+    try:
+        pickle.dumps(results)
+    except Exception:
+        raise UncacheableResult(results)
+    return results
+
+# rows of a result sheet sent to the browser per rerun
+MAX_RENDER_ROWS = 200
 
 # --------------------- Upload rules ---------------------
 st.header("1) Upload rules (.py)")
@@ -65,6 +151,7 @@ if rules_file:
         module, module_path = safe_import_pyfile(rules_file)
         st.session_state["rules_module"] = module
         st.session_state["rules_module_path"] = module_path
+        st.session_state["rules_module_digest"] = hashlib.sha256(rules_file.getvalue()).hexdigest()
         st.success("✅ Rules file loaded and module imported.")
         # show a short info about check_rules presence
         if hasattr(module, "check_rules") and callable(module.check_rules):
@@ -76,29 +163,38 @@ if rules_file:
         st.code(traceback.format_exc())
         st.session_state.pop("rules_module", None)
         st.session_state.pop("rules_module_path", None)
+        st.session_state.pop("rules_module_digest", None)
 
 # --------------------- Upload data ---------------------
 st.header("2) Upload data (.xlsx or .csv)")
 data_file = st.file_uploader("Upload Excel (.xlsx) or CSV (.csv) to validate", type=["xlsx", "csv"], key="data_uploader")
 
 df_preview = None
+# the upload is read into memory once per script run; previews and check_rules get their own BytesIO
+data_bytes = data_file.getvalue() if data_file else None
 if data_file:
     try:
         if data_file.name.lower().endswith(".xlsx"):
-            xls = pd.ExcelFile(data_file)
-            first_sheet = xls.sheet_names[0]
-            df_preview = xls.parse(first_sheet)
+            first_sheet, df_preview = read_excel_preview(data_bytes, data_file.name)
             st.write(f"Preview of first sheet: **{first_sheet}**")
-            st.dataframe(df_preview.head(10))
+            st.dataframe(df_preview)
         else:
-            df_preview = pd.read_csv(data_file)
+            # only the rows we display are parsed, not the whole file
+            df_preview = pd.read_csv(io.BytesIO(data_bytes), nrows=10)
             st.write("Preview (CSV):")
-            st.dataframe(df_preview.head(10))
+            st.dataframe(df_preview)
     except Exception as e:
         st.error(f"Could not read data file: {e}")
         st.code(traceback.format_exc())
 
 # --------------------- Run validation ---------------------
+# identifies the current uploads without hashing them: Streamlit gives every upload its own file_id
+run_inputs = (data_file.file_id if data_file else None, st.session_state.get("rules_module_digest"))
+if st.session_state.get("last_run_inputs") != run_inputs:
+    # stored results belong to other uploads
+    for key in ("last_results", "last_findings", "last_results_key", "last_run_inputs"):
+        st.session_state.pop(key, None)
+
 st.header("3) Run validation")
 run_col1, run_col2 = st.columns([1,3])
 run_button = run_col1.button("▶️ Run validation", disabled=("rules_module" not in st.session_state or data_file is None))
@@ -108,12 +204,25 @@ if run_button:
         st.error("No rules module loaded. Please upload a rules .py file first.")
     elif data_file is None:
         st.error("No data file uploaded. Please upload Excel or CSV file to validate.")
+    elif "last_results" in st.session_state:
+        # same uploads as the stored results: nothing to parse, run or count again
+        st.success("Validation results below are already up to date for these files.")
     else:
-        # Run check_rules and show summary
+        # Run check_rules (stored results of other uploads were already dropped above)
+        results_key = (hashlib.sha256(data_bytes).hexdigest(), st.session_state["rules_module_digest"])
         try:
             with st.spinner("Running check_rules..."):
-                # pass the uploaded file object directly (most of your functions use pd.ExcelFile which accepts file-like)
-                results = st.session_state["rules_module"].check_rules(data_file)
+                # check_rules gets a fresh file-like copy of the upload (pd.ExcelFile accepts file-like)
+                try:
+                    results = run_rules(
+                        data_bytes,
+                        data_file.name,
+                        st.session_state["rules_module_digest"],
+                        st.session_state["rules_module"],
+                    )
+                except UncacheableResult as e:
+                    # shown as before, just not cached
+                    results = e.result
         except Exception as e:
             st.error("Error while running rules. See traceback for details.")
             st.code(traceback.format_exc())
@@ -129,38 +238,55 @@ if run_button:
                 results = None
 
             if results:
-                # Build and show summary table quickly
-                summary = []
-                for sheet_name, df in results.items():
-                    if isinstance(df, pd.DataFrame):
-                        total = len(df)
-                        found = count_findings_in_df(df)
-                    else:
-                        total = 0
-                        found = 0
-                    summary.append({"Sheet": sheet_name, "Total Rows": total, "Findings": found})
-                summary_df = pd.DataFrame(summary).sort_values("Findings", ascending=False).reset_index(drop=True)
-                st.markdown("### 📋 Summary of Findings")
-                st.dataframe(summary_df)
-
-                # Show small per-sheet previews (first 10 rows); we will expand later with tabs
-                st.markdown("### 🔎 Per-sheet preview")
-                for sheet_name, df in results.items():
-                    st.subheader(sheet_name)
-                    if isinstance(df, pd.DataFrame):
-                        if df.empty:
-                            st.success("No issues found in this sheet!")
-                        else:
-                            # show up to first 10 rows (optionally filtered later)
-                            with st.expander(f"Show up to 200 rows of {sheet_name} (first 10 shown)"):
-                                st.dataframe(df.head(200))
-                    else:
-                        st.write(df)
-
-                # store results in session_state for next steps (tabs, downloads in future)
+                # store results in session_state so they stay on screen across reruns
                 st.session_state["last_results"] = results
+                st.session_state["last_results_key"] = results_key
+                st.session_state["last_run_inputs"] = run_inputs
+                # findings are counted once per run, not on every rerun that redraws the results
+                st.session_state["last_findings"] = {
+                    sheet_name: count_findings_in_df(df) for sheet_name, df in results.items()
+                }
                 st.success("Validation finished and results stored in session state.")
 
+# --------------------- Results ---------------------
+results = st.session_state.get("last_results")
+findings = st.session_state.get("last_findings", {})
+if results:
+    # the summary is filled in after the per-sheet loop but shown above it
+    st.markdown("### 📋 Summary of Findings")
+    summary_slot = st.empty()
+
+    # One pass over the sheets: collect summary counts and fill one tab per sheet
+    st.markdown("### 🔎 Per-sheet results")
+    tabs = st.tabs([str(sheet_name) for sheet_name in results])
+    summary = []
+    # widget keys carry the run identity, so a new run does not inherit the previous run's ticks
+    run_id = st.session_state["last_results_key"]
+    for i, (tab, (sheet_name, df)) in enumerate(zip(tabs, results.items())):
+        with tab:
+            if isinstance(df, pd.DataFrame):
+                total = len(df)
+                found = findings.get(sheet_name, 0)
+                if df.empty:
+                    st.success("No issues found in this sheet!")
+                else:
+                    st.write(f"{total} rows, {found} with findings")
+                    # rows are only serialized to the browser once asked for; keyed by tab position
+                    # since str(sheet_name) can collide (1 vs "1")
+                    if st.checkbox(f"Show up to {MAX_RENDER_ROWS} rows of {sheet_name}", key=f"show_rows_{run_id}_{i}"):
+                        st.dataframe(df.head(MAX_RENDER_ROWS), hide_index=True)
+                        if total > MAX_RENDER_ROWS:
+                            st.info(f"Showing first {MAX_RENDER_ROWS} of {total:,} rows.")
+            else:
+                total = 0
+                found = 0
+                st.write(df)
+        summary.append((sheet_name, total, found))
+    # a handful of rows: sort the tuples in Python and build the frame once with fixed columns
+    summary.sort(key=lambda row: row[2], reverse=True)
+    summary_df = pd.DataFrame.from_records(summary, columns=["Sheet", "Total Rows", "Findings"])
+    summary_slot.dataframe(summary_df)
+
 # footer
 st.markdown("---")
-st.markdown("Next: after you confirm this works, I'll add: tabs, highlighted rows, downloadable multi-sheet Excel, and charts.")
+st.markdown("Next: after you confirm this works, I'll add: highlighted rows, downloadable multi-sheet Excel, and charts.")